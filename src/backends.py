@@ -0,0 +1,141 @@
+import abc
+import numpy as np
+from arch import arch_model
+from src import generator_utils as gutils
+
+BACKCAST_LEN = 75  # observations used by 'arch' to backcast the initial variance (exponentially weighted)
+BACKCAST_DECAY = 0.94
+
+
+@gutils.njit(cache=True)
+def simulate_ar_garch11(const, phi, omega, alpha, beta, ts, z):
+    """
+    This function simulates an AR(p)-GARCH(1,1) with fixed parameters from the end of a series,
+    as 'arch' does for a fixed model: the variance is filtered over ts starting from a backcast of the residuals.
+    :param const: constant of the mean model
+    :param phi: AR coefficients (p)
+    :param omega: constant of the variance model
+    :param alpha: ARCH coefficient
+    :param beta: GARCH coefficient
+    :param ts: time series of returns (array of floats)
+    :param z: standard normal draws, (paths x steps simulated)
+    :return: (paths x steps) array of the values simulated
+    """
+    p, n = len(phi), len(ts)
+    # Residuals of the mean model (the first p observations are only used as lags)
+    resids = np.empty(n - p)
+    for t in range(p, n):
+        mu = const
+        for k in range(p):
+            mu += phi[k] * ts[t - k - 1]
+        resids[t - p] = ts[t] - mu
+
+    # Backcast and conditional variance till the last observation
+    w_sum, backcast = 0.0, 0.0
+    for i in range(min(BACKCAST_LEN, len(resids))):
+        w = BACKCAST_DECAY ** i
+        w_sum += w
+        backcast += w * resids[i] ** 2
+    eps2 = sigma2 = backcast / w_sum
+    for t in range(len(resids)):
+        sigma2 = omega + alpha * eps2 + beta * sigma2
+        eps2 = resids[t] ** 2
+
+    # Simulation of each path from the last observation
+    m_sim, n_steps = z.shape
+    y = np.empty((m_sim, p + n_steps))
+    for m in range(m_sim):
+        y[m, :p] = ts[n - p:]
+        path_eps2, path_sigma2 = eps2, sigma2
+        for h in range(n_steps):
+            path_sigma2 = omega + alpha * path_eps2 + beta * path_sigma2
+            eps = np.sqrt(path_sigma2) * z[m, h]
+            mu = const
+            for k in range(p):
+                mu += phi[k] * y[m, p + h - k - 1]
+            y[m, p + h] = mu + eps
+            path_eps2 = eps * eps
+    return y[:, p:]
+
+
+class ArmaGarchBackend(abc.ABC):
+    """
+    Library used to fit ARMA-GARCH models and to simulate from them.
+    'rugarch' (R) is called directly from Model, while native Python libraries implement this interface.
+    """
+
+    @abc.abstractmethod
+    def fit(self, ts, p, q, g_p=1, g_q=1):
+        """
+        This function fits an ARMA(p, q)-GARCH(g_p, g_q) model.
+        :param ts: time series of returns
+        :return: fitted model
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_garch_coef(self, fitted):
+        """ This function returns the GARCH coefficients (omega, sum of alphas, sum of betas) of a fitted model. """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_infocrit(self, fitted):
+        """ This function returns [Akaike (AIC), Bayes (BIC), Shibata, Hannan - Quinn] of a fitted model. """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def simulate(self, fitted, ts, p, g_p=1, g_q=1, n_steps=1, m_sim=1, rng=None):
+        """
+        This function simulates the n_steps that follow ts with the parameters of a fitted model.
+        :param m_sim: number of paths simulated
+        :param rng: random generator of the innovations (np.random.Generator, a new unseeded one if None)
+        :return: array of n_steps values per path (paths concatenated)
+        """
+        raise NotImplementedError
+
+
+class ArchBackend(ArmaGarchBackend):
+    """
+    ARMA-GARCH models of the 'arch' package, implemented in Cython/NumPy (no R interpreter nor rpy2 conversions).
+    The mean model of 'arch' is autoregressive (ARX), so MA lags (q) are not used.
+    """
+
+    def __init__(self, dist: str = 'normal'):
+        self.dist = dist
+
+    def get_model(self, ts, p, g_p=1, g_q=1):
+        return arch_model(np.asarray(ts, dtype=np.float64), mean='ARX', lags=p,
+                          vol='GARCH', p=g_p, q=g_q, dist=self.dist)
+
+    def fit(self, ts, p, q, g_p=1, g_q=1):
+        return self.get_model(ts, p, g_p, g_q).fit(disp='off')
+
+    def get_garch_coef(self, fitted):
+        params = fitted.params
+        return params['omega'], sum(params[params.index.str.startswith('alpha')]), \
+            sum(params[params.index.str.startswith('beta')])
+
+    def get_infocrit(self, fitted):
+        # Per observation, as these are given by rugarch's infocriteria
+        n, k, llf = fitted.nobs, fitted.num_params, fitted.loglikelihood
+        return fitted.aic / n, fitted.bic / n, -2 * llf / n + np.log((n + 2 * k) / n), \
+            (-2 * llf + 2 * k * np.log(np.log(n))) / n
+
+    def simulate(self, fitted, ts, p, g_p=1, g_q=1, n_steps=1, m_sim=1, rng=None):
+        rng = np.random.default_rng() if rng is None else rng
+        if g_p == 1 and g_q == 1 and self.dist == 'normal':
+            # Params: Const, AR lags, omega, alpha[1], beta[1]
+            params = np.asarray(fitted.params, dtype=np.float64)
+            return simulate_ar_garch11(params[0], params[1:p + 1], params[p + 1], params[p + 2], params[p + 3],
+                                       np.asarray(ts, dtype=np.float64),
+                                       rng.standard_normal((m_sim, n_steps))).ravel()
+        # Other orders / distributions:
+        # the parameters are fixed on the series passed, so the simulation starts from its last values
+        model = self.get_model(ts, p, g_p, g_q)
+        try:
+            model.distribution = type(model.distribution)(seed=rng)  # innovations drawn from rng
+        except TypeError:  # arch < 5 (random_state instead of seed)
+            model.distribution = type(model.distribution)(random_state=np.random.RandomState(rng.integers(2 ** 32)))
+        fixed = model.fix(fitted.params)
+        forecast = fixed.forecast(horizon=n_steps, method='simulation', simulations=m_sim)
+        return np.asarray(forecast.simulations.values)[-1].ravel()
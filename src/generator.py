@@ -2,18 +2,41 @@ import pandas as pd
 import numpy as np
 import os
 import yaml
-import random
+try:
+    from yaml import CSafeLoader as YAMLLoader  # libyaml
+except ImportError:
+    from yaml import SafeLoader as YAMLLoader
+import tempfile
+import contextlib
+import joblib
+from joblib import Parallel, delayed
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:  # optional, BLAS threads are not limited without it
+    threadpool_limits = None
+try:
+    import pmdarima as pm
+except ImportError:  # optional, only needed by the stepwise ARMA search
+    pm = None
 from enum import Enum
-import statsmodels.tsa.api as smt
+from statsmodels.tsa.arima.model import ARIMA
 import logging
-import multiprocessing
+import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from functools import partial
 from src import generator_utils as gutils
-from src.model import Model
+from src.model import Model, init_rlib
 from matplotlib import pyplot as plt
 import calendar
 import time
+logger = logging.getLogger(__name__)
 MODEL_DICT_NAMES = 'fitted_'
+EVENT_COLS = ['n_row', 'new_switch', 'cur_switch', 'weights', 'current_model_id', 'new_model_id']
+WORKER_CONF = dict()  # config of the tasks of each worker process, set by 'init_worker'
+FIT_PARAMS = ['param_search', 'search', 'pq_rng', 'pq_rng_steps', 'init_p', 'd_rng', 'garch_pq_rng']  # used to fit
+MODELS_CACHE_VERSION = 1  # increase it to invalidate the models cache (the source code of 'src' is also part of the key)
+MIN_SWITCH_SHARPNESS = 0.0002  # switches with a lower sharpness use this one
+SIGMOID_LUT = np.asarray(gutils.get_sigmoid(), dtype=np.float64)  # computed once, indexed as int(w0*100)
 
 
 class Switch(Enum):
@@ -23,26 +46,44 @@ class Switch(Enum):
     PREDEFINED = 2
 
 
+SWITCH_NAMES = np.array([switch.name for switch in Switch], dtype=object)  # indexed as Switch.value + 1
+
+
 def parse_yaml():
     """ This function parses the config file and returns options, paths, etc."""
     # Read YAML file
     with open("config.yaml", 'r') as stream:
-        config = yaml.safe_load(stream)
+        config = yaml.load(stream, Loader=YAMLLoader)
         input_data_config = config['input']
         global_params = config['params']
         out_format = config['output']
         plot = config['plot']
-        armagarch_lib = {'lib': 'rugarch', 'env': config['env']['r_libs_path']}
-        print(config)
+        armagarch_lib = {'lib': config['env'].get('armagarch_lib', 'rugarch'), 'env': config['env']['r_libs_path']}
         logging.info(config)
 
     return input_data_config, global_params, out_format, armagarch_lib, plot
 
 
-def instantiate_model(config, show_plt, file_config):
+def init_worker(conf: dict(), armagarch_lib: dict() = None):
     """
-    This handles each thread in 'instantiate_models'
-    :param config: from YAML file
+    This function initialises each worker of a pool of processes, so the configuration shared by all the tasks
+    is sent once per worker instead of with every task.
+    :param conf: configuration read by the tasks (see 'fit_model')
+    :param armagarch_lib: library name and environment paths to load the R library once per worker (optional).
+        As the models are fitted in parallel, the BLAS and OpenMP libraries of these workers use a single thread.
+    """
+    WORKER_CONF.update(conf)
+    if armagarch_lib is not None:
+        os.environ['OMP_NUM_THREADS'] = '1'  # read by R and its libraries when loaded
+        if threadpool_limits is not None:
+            threadpool_limits(limits=1)  # libraries already loaded (numpy)
+        init_rlib(armagarch_lib)
+
+
+def instantiate_model(config: dict(), show_plt: bool, file_config):
+    """
+    This handles each thread in 'instantiate_models'.
+    :param config: input datasets config from the YAML file
     :param show_plt: plot series?
     :param file_config: list of ids, files and probabilities.
     :return: model and desc tuple
@@ -50,30 +91,31 @@ def instantiate_model(config, show_plt, file_config):
     # 1. Read dataset for model
     print(file_config)
     counter, file, preconf, prob, multiplier = file_config
-    df = pd.read_csv(os.path.join(config['path'], file), sep=config['sep'])  # , header=None)
-    # df.columns = config['cols']
-    try:
-        df.set_index(keys=config['index_col'], drop=True, inplace=True)
-    except Exception as e:
-        print(e)
-        print(df.head())
-        df.set_index(keys=config['index_col'], drop=True, inplace=True)
+    # Only the index and the simulated column are parsed (the latter straight to floats, no type inference)
+    df = pd.read_csv(os.path.join(config['path'], file), sep=config['sep'],
+                     usecols=[config['index_col'], config['sim_col']], index_col=config['index_col'],
+                     dtype={config['sim_col']: np.float64}, engine=config.get('csv_engine', 'c'))
     # 2. Clean nulls and select series
     raw_series = df[[config['sim_col']]]  # .dropna()
-    raw_returns_series = 100 * df[[config['sim_col']]].pct_change()  # .dropna()
-    # the returns later are calculated in a different way and they use log scale
 
     # Plot initial df and returns
     if show_plt:
+        # These returns (%) are only plotted, the returns later are calculated in a different way and use log scale
+        prices = raw_series[config['sim_col']].to_numpy()
+        returns = np.empty_like(prices)
+        returns[0] = np.nan
+        np.subtract(prices[1:], prices[:-1], out=returns[1:])
+        np.divide(returns[1:], prices[:-1], out=returns[1:])
+        returns *= 100
         gutils.plot_input(df, 'Raw dataset')
         gutils.plot_input(raw_series, 'Prices')
-        gutils.plot_input(raw_returns_series, 'Returns')
+        gutils.plot_input(pd.DataFrame(returns, index=raw_series.index, columns=[config['sim_col']]), 'Returns')
 
     # 3. Prepare Model and return it to be added to a dictionary
     mdl = Model(id=counter, raw_input_path=os.path.join(config['path'], file),
                 input_ts=gutils.prepare_raw_series(config['parsing_mode'], raw_series),
                 param_log=[],
-                rec_price=list(raw_series[config['sim_col']])[-1],  # last fitting price will be used for reconstruction
+                rec_price=raw_series[config['sim_col']].iat[-1],  # last fitting price will be used for reconstruction
                 probability=prob,
                 multiplier=multiplier,
                 ARMAGARCH_preconf=preconf)
@@ -90,56 +132,196 @@ def instantiate_models(input_data_config: dict(), show_plt: bool = True):
     """
     # Load raw time series for the pre-training of the models
     logging.info('Load models...')
-    pool = multiprocessing.Pool(len(input_data_config['files']))  # gutils.MyPool(1)
-    mapped = pool.map(partial(instantiate_model, input_data_config, show_plt), input_data_config['files'])
-    series_dict = dict(map(reversed, tuple(mapped)))
+    files = input_data_config['files']
+    # Threads, as parsing the CSVs (pandas' C parser) releases the GIL and nothing needs to be pickled.
+    # The config is shared by the threads, and the plots are drawn by a single thread (pyplot is not thread-safe).
+    with ThreadPoolExecutor(max_workers=1 if show_plt else min(len(files), os.cpu_count())) as executor:
+        series_dict = {name: mdl for mdl, name in
+                       executor.map(partial(instantiate_model, input_data_config, show_plt), files)}
     return series_dict
 
 
-def get_best_arma_parameters(ts: list(), config: dict()):
+def fit_arma(ts: np.ndarray, order: tuple, start_params: np.ndarray = None):
+    """
+    This function fits an ARIMA model (no trend) of the given order.
+    The exact likelihood is computed with the innovations algorithm and the covariance of the parameters,
+    never read, is skipped.
+    :param ts: time series of returns as an array of floats
+    :param order: (p, d, q)
+    :param start_params: initial parameters of the optimizer (warm start). If the fit fails from these, it starts over.
+    :return: fitted model
+    """
+    mdl = ARIMA(ts, order=order, trend='n')
+    if start_params is not None:
+        try:
+            return mdl.fit(start_params=start_params, method='innovations_mle', low_memory=True, cov_type='none')
+        except Exception:
+            pass  # e.g. non-stationary or non-invertible starting parameters
+    return mdl.fit(method='innovations_mle', low_memory=True, cov_type='none')
+
+
+def get_start_params(order: tuple, params: dict()):
+    """
+    This function returns starting parameters for an ARMA(p, q) from a fitted model where it is nested,
+    (p, q + 1) or (p + 1, q), dropping its last AR or MA lag.
+    :param order: (p, q)
+    :param params: dictionary (p, q) -> parameters (AR lags, MA lags, variance) of the fitted models
+    :return: starting parameters (None if none of these models has been fitted)
+    """
+    p, q = order
+    for sup_p, sup_q in ((p, q + 1), (p + 1, q)):
+        if (sup_p, sup_q) in params:
+            sup_params = params[(sup_p, sup_q)]
+            return np.concatenate([sup_params[:p], sup_params[sup_p:sup_p + q], sup_params[-1:]])
+    return None
+
+
+def fit_arma_order(ts: np.ndarray, order: tuple, start_params: np.ndarray = None):
+    """
+    This handles each job of the grid search in 'get_best_arma_parameters'.
+    As the fits run in parallel, each of them is limited to one BLAS thread.
+    :param ts: time series of returns as an array of floats
+    :param order: (p, d, q)
+    :param start_params: initial parameters of the optimizer (see 'get_start_params')
+    :return: order, log-likelihood, AIC and fitted model (None if the fit failed)
+    """
+    # The limits are restored on exit (context manager of threadpoolctl 2.x and 3.x)
+    with threadpool_limits(limits=1) if threadpool_limits is not None else contextlib.ExitStack():
+        try:
+            tmp_mdl = fit_arma(ts, order, start_params)
+            # AIC from the log-likelihood, as the results are not needed for anything else
+            llf = tmp_mdl.llf
+            return order, llf, 2 * (order[0] + order[2] + 1) - 2 * llf, tmp_mdl  # p + q + variance params
+        except Exception:
+            return order, -np.inf, np.inf, None
+
+
+def get_aic_lower_bound(order: tuple, llf: dict()):
+    """
+    This function returns a lower bound of the AIC of an ARMA(p, q) from the models already fitted (branch and bound).
+    A nested model cannot reach a higher log-likelihood than the models where it is nested (p' >= p, q' >= q).
+    The best of them is used, so a supermodel that did not converge does not prune the orders nested in it.
+    :param order: (p, q)
+    :param llf: dictionary (p, q) -> log-likelihood of the fitted models
+    :return: AIC lower bound (-inf if none of its supermodels has been fitted yet)
+    """
+    p, q = order
+    sup_llf = [ll for (sup_p, sup_q), ll in llf.items() if sup_p >= p and sup_q >= q]
+    return 2 * (p + q + 1) - 2 * max(sup_llf) if len(sup_llf) > 0 else -np.inf  # p + q + variance params
+
+
+def get_stepwise_arma_parameters(ts: np.ndarray, config: dict()):
+    """
+    Stepwise (Hyndman-Khandakar) alternative to the grid search in 'get_best_arma_parameters'.
+    Only the orders around the current best one are fitted at each step, instead of all the (p, d, q) combinations
+    in the grid. As in the grid, models have no intercept, are compared by AIC and p, q >= 1 (if the search ends
+    in p or q = 0, that lag is set to 1 and the model is fitted again). Unlike the grid, d is selected with a KPSS
+    test instead of by AIC.
+    @:param TS: time series of returns used for pre-training
+    """
+    if pm is None:
+        raise ImportError("config['search'] = 'stepwise' needs pmdarima (optional in requirements.txt), "
+                          "use 'grid' otherwise")
+    try:
+        mdl = pm.auto_arima(ts, start_p=1, max_p=config['pq_rng'], start_q=1, max_q=config['pq_rng'],
+                            d=None, max_d=config['d_rng'] - 1, seasonal=False, stepwise=True, with_intercept=False,
+                            information_criterion='aic', error_action='ignore', suppress_warnings=True)
+    except Exception as e:
+        logging.error(f'Stepwise ARMA search failed: {e}')
+        raise ValueError('No ARMA model could be fitted by the stepwise search') from e
+    p, d, q = mdl.order
+    best_order = (max(p, 1), d, max(q, 1))
+    if best_order == mdl.order:
+        best_aic, best_mdl = mdl.aic(), mdl
+    else:
+        _, _, best_aic, best_mdl = fit_arma_order(np.asarray(ts, dtype=np.float64), best_order)
+        if best_mdl is None:
+            raise ValueError(f'ARMA{best_order} could not be fitted after the stepwise search')
+    print('aic: {:6.5f} | order: {}'.format(best_aic, best_order))
+    return best_aic, best_order, best_mdl
+
+
+def get_best_arma_parameters(ts: np.ndarray, config: dict(), n_jobs: int = None):
     """
     If selected, this list returns the best ARMA model for the current pre-training period.
     Cos and ARMA-GARCH(1,1) may be good enough:
         https://stats.stackexchange.com/questions/175400/optimal-lag-order-selection-for-a-garch-model
+    The whole grid is only explored if config['search'] is 'grid' (kept for validation), otherwise
+    the search is stepwise.
     @:param TS: time series of returns used for pre-training
+    :param n_jobs: max number of processes of the grid search (all the cores if None)
     """
+    if config['search'] == 'stepwise':
+        return get_stepwise_arma_parameters(ts, config)
+
     best_aic = np.inf
     best_order = None
     best_mdl = None
+    endog = np.asarray(ts, dtype=np.float64)  # no copy if it is already an array of floats
+    pq_rng = config['pq_rng']
 
-    for i in range(1, config['pq_rng'] + 1):   # [0,1,2,3,4]
+    with Parallel(n_jobs=-1 if n_jobs is None else n_jobs, backend='loky') as parallel:
         for d in range(config['d_rng']):  # [0] # we'll use arma-garch, so not d (= 0)
-            for j in range(1, config['pq_rng'] + 1):
-                try:
-                    tmp_mdl = smt.ARIMA(ts, order=(i, d, j)).fit(
-                        method='mle', trend='nc'
-                    )
-                    tmp_aic = tmp_mdl.aic
+            llf = dict()  # (p, q) -> log-likelihood of the models fitted for this d
+            params = dict()  # (p, q) -> parameters of the models fitted for this d, to warm start the nested ones
+            # Orders of the same size (p + q) are fitted in parallel, from the largest to the smallest size,
+            # so supermodels are fitted before the models nested in them
+            for size in range(2 * pq_rng, 1, -1):
+                wave = [(i, size - i) for i in range(min(pq_rng, size - 1), max(1, size - pq_rng) - 1, -1)]
+                # orders that cannot beat the best model so far are not fitted
+                wave = [(i, j) for (i, j) in wave if get_aic_lower_bound((i, j), llf) < best_aic]
+                for (i, _, j), tmp_llf, tmp_aic, tmp_mdl in \
+                        parallel(delayed(fit_arma_order)(endog, (i, d, j), get_start_params((i, j), params))
+                                 for (i, j) in wave):
+                    if tmp_mdl is None:
+                        continue
+                    llf[(i, j)] = tmp_llf
+                    params[(i, j)] = np.asarray(tmp_mdl.params)
                     if tmp_aic < best_aic:
                         best_aic = tmp_aic
                         best_order = (i, d, j)
                         best_mdl = tmp_mdl
-                except:
-                    continue
+    if best_order is None:
+        logging.error('None of the ARMA orders of the grid could be fitted')
+        raise ValueError('No ARMA model could be fitted by the grid search')
     print('aic: {:6.5f} | order: {}'.format(best_aic, best_order))
     return best_aic, best_order, best_mdl
 
 
-def fit_model(show_plt: bool, tool_params: dict(), armagarch_lib: dict(), series_model):
+def fit_model(series_model):
     """
-    This handles each thread in 'fit_models'
-    :param tool_params: YAML dict with model params
-    :param armagarch_lib: library name and environment paths to load an R library for ARMA-GARCH
-    :param show_plt: plot series?
+    This handles each thread in 'fit_models'. These are set by 'init_worker':
+    tool_params (YAML dict with model params), armagarch_lib (library name and environment paths to load an R library
+    for ARMA-GARCH), show_plt (plot series?), models_dir (folder where the fitted model is stored)
+    and search_procs (max number of processes of the ARMA-GARCH search).
+    If tool_params['models_cache'] is set (then it is models_dir), fitted models are reused by later runs
+    whose model (input series included), fitting params (FIT_PARAMS), library and code (models_cache_salt) are the same.
+    Models that fail to fit are not cached.
     :param series_model: list of series as an object of Model.
-    :return: fitted model and description to be added to dictionary
+    :return: path of the fitted model and description to be added to dictionary
     """
+    tool_params, armagarch_lib = WORKER_CONF['tool_params'], WORKER_CONF['armagarch_lib']
+    show_plt, models_dir = WORKER_CONF['show_plt'], WORKER_CONF['models_dir']
     name_series, current_model = series_model
+    use_cache = tool_params.get('models_cache') is not None
+    if use_cache:
+        key = joblib.hash((current_model, {param: tool_params[param] for param in FIT_PARAMS}, armagarch_lib,
+                           WORKER_CONF['models_cache_salt']), hash_name='sha1')
+        model_path = os.path.join(models_dir, f'{key}.joblib')
+        if os.path.exists(model_path):
+            print(f'fitted model for {name_series} {current_model.id} loaded from {model_path}')
+            return model_path, name_series
+    else:
+        model_path = os.path.join(models_dir, f'{name_series}.joblib')
     print(f'fitting model for {name_series} {current_model.id}: {current_model.raw_input_path}')
+    # The input series does not change for the life of the fitted model, so it is converted once
+    current_model.input_ts_array = np.ascontiguousarray(current_model.input_ts, dtype=np.float64)
 
     # logging.info(f'\n\n 1. Setting ARMAGARCH library for model {current_model.id}')
     if tool_params['param_search'] == 'ARMA':
-        _, ARMA_order, ARMA_model = get_best_arma_parameters(ts=list(current_model.input_ts), config=tool_params)  #
+        # Only p and q are used to fit (d is not, as in ARMA-GARCH)
+        _, ARMA_order, ARMA_model = get_best_arma_parameters(ts=current_model.input_ts_array, config=tool_params,
+                                                         n_jobs=WORKER_CONF['search_procs'])  #
         # ARMA_order = (4, 0, 4)
         print(current_model.id)
         print('Best parameters are: ')
@@ -157,7 +339,7 @@ def fit_model(show_plt: bool, tool_params: dict(), armagarch_lib: dict(), series
 
     elif tool_params['param_search'] == 'ARMA_GARCH':
         best_aic, best_order, best_model, best_coef = \
-            current_model.get_best(current_model.input_ts, tool_params, armagarch_lib)
+            current_model.get_best(current_model.input_ts, tool_params, armagarch_lib, WORKER_CONF['search_procs'])
         # print(f'best coefficients are: {best_coef}')
         current_model.set_lags(*best_order)
         current_model.set_coef(best_coef)
@@ -181,11 +363,35 @@ def fit_model(show_plt: bool, tool_params: dict(), armagarch_lib: dict(), series
     logging.info(current_model.coef_names)
     logging.info(current_model.coef)
     logging.info("==========")
-    return current_model, name_series  # name_series = f'{MODEL_DICT_NAMES}{counter}'
+
+    if use_cache and current_model.ARMAGARCHfitted is None:
+        logging.warning(f'model {name_series} {current_model.id} did not fit, so it is not cached')
+        model_path = os.path.join(WORKER_CONF['tmp_dir'], f'{name_series}.joblib')
+    # Only the path goes back to the main process (see gutils.LazyModelDict).
+    # Dumped to a temporary file first, so an interrupted run does not leave a truncated model in the cache.
+    tmp_path = f'{model_path}.{os.getpid()}.tmp'
+    joblib.dump(current_model, tmp_path)
+    os.replace(tmp_path, model_path)
+    return model_path, name_series  # name_series = f'{MODEL_DICT_NAMES}{counter}'
+
+
+def get_models_cache_salt():
+    """
+    This function returns the part of the keys of the models cache that depends on the code, so changes in the
+    modules in 'src' (or in MODELS_CACHE_VERSION) fit the models again instead of loading the ones fitted before.
+    :return: hash of MODELS_CACHE_VERSION and the source files of 'src'
+    """
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    sources = []
+    for file_name in sorted(os.listdir(src_dir)):
+        if file_name.endswith('.py'):
+            with open(os.path.join(src_dir, file_name), 'rb') as f:
+                sources.append(f.read())
+    return joblib.hash((MODELS_CACHE_VERSION, sources), hash_name='sha1')
 
 
 def fit_models(series_dict: dict(), input_data_conf: dict(), params: dict(),
-               armagarch_lib: dict(), show_plt: bool = False):
+               armagarch_lib: dict(), show_plt: bool = False, tmp_dir: str = None):
     """
     This function triggers the selection of the best parameters and fitting of n models
      (one model per dataset added to the YAML config file).
@@ -194,67 +400,133 @@ def fit_models(series_dict: dict(), input_data_conf: dict(), params: dict(),
     :param input_data_conf - dictionary from YAML with input datasets-related configuration
     :param params: YAML dict with model params
     :param plot - plot model?
-    :return list of fitted models
+    :param tmp_dir: folder of the fitted models that are not cached, removed by the caller once they are not needed
+        (a new one if None)
+    :return dict of fitted models (loaded from disk the first time each one is used)
     """
     # Fit models in parallel
     logging.info('Fitting models...')
-    n_threads = 4
-    pool = gutils.MyPool(n_threads)  # multiprocessing.Pool(processes=len(input_data_conf['files']))
-    mapped = pool.map(partial(fit_model, show_plt, params, armagarch_lib), series_dict.items())
+    n_proc = min(len(series_dict), os.cpu_count())
+    models_cache_salt = None
+    tmp_dir = tempfile.mkdtemp(prefix=MODEL_DICT_NAMES) if tmp_dir is None else tmp_dir
+    if params.get('models_cache') is None:
+        models_dir = tmp_dir
+    else:
+        models_dir = params['models_cache']
+        os.makedirs(models_dir, exist_ok=True)
+        models_cache_salt = get_models_cache_salt()
+    # Non-daemonic workers, as the parameter search of each model runs in its own pool of processes.
+    # The config and the R library are loaded once per worker instead of once per model.
+    # The cores are split between the models, so their searches do not start more processes than cores in total.
+    worker_conf = {'tool_params': params, 'armagarch_lib': armagarch_lib, 'show_plt': show_plt, 'models_dir': models_dir,
+                   'search_procs': max(1, os.cpu_count() // n_proc), 'models_cache_salt': models_cache_salt,
+                   'tmp_dir': tmp_dir}
+    with ProcessPoolExecutor(max_workers=n_proc, mp_context=gutils.NoDaemonContext(),
+                             initializer=init_worker, initargs=(worker_conf, armagarch_lib)) as executor:
+        mapped = executor.map(fit_model, series_dict.items(),
+                              chunksize=gutils.get_chunksize(len(series_dict), n_proc))
+        fitted_dict = gutils.LazyModelDict({name: model_path for model_path, name in mapped})
     logging.info('End models...')
-    return dict(map(reversed, tuple(mapped)))
+    return fitted_dict
 
 
-def update_weights(w, switch_sharpness):
+@gutils.njit(cache=True)
+def update_weights(w0, switch_sharpness):
     """
     This function updates weights each iteration depending on the sharpness of the current switch.
-    :param w: tuple of weights
+    :param w0: weight of the current model (the one of the new model is 1 - w0)
     :param switch_sharpness: speed of changes
-    :return: tuple of weights updated.
+    :return: weight of the current model updated.
     """
-    min_sp = 0.0002
-    if switch_sharpness < min_sp:
-        print(f'Minimum switch abrupcy is {min_sp}, so this is the value being used. ')
-        switch_sharpness = min_sp
-    # else:
-    #     print(f'switch_sharpness is {switch_sharpness}')
-    incr = switch_sharpness
-    w = (w[0] - incr, w[1] + incr)
+    incr = max(switch_sharpness, MIN_SWITCH_SHARPNESS)  # see the warning in 'switching_process'
 
     # see for reference get_weight and reset_weights.
-    w = (0 if w[0] <= 0 else w[0], 1 if w[1] >= 1 else w[1])  # deal with numbers out of range
-    return w
+    return max(w0 - incr, 0.0)  # deal with numbers out of range
+
+
+@gutils.njit(cache=True)
+def get_switch_weights(switch_sharpness, use_sig_w, sig_lut):
+    """
+    This function computes the weights of all the steps of a switch at once, iterating 'update_weights'
+    from the initial weights until the new model takes over.
+    :param switch_sharpness: speed of changes
+    :param use_sig_w: apply the sigmoid kernel to the weights?
+    :param sig_lut: sigmoid lookup table (SIGMOID_LUT)
+    :return: arrays of the weights of the current model and of the weights applied to its forecasts, per step
+    (the new model gets 1 - weight).
+    """
+    max_steps = int(1.0 / max(switch_sharpness, MIN_SWITCH_SHARPNESS)) + 2
+    w_steps = np.empty(max_steps)
+    blend_steps = np.empty(max_steps)
+    w0 = update_weights(1.0, switch_sharpness)
+    n = 0
+    while 0 < w0 < 1:
+        w_steps[n] = w0
+        blend_steps[n] = sig_lut[int(w0 * 100)] if use_sig_w else w0  # kernel to sig func
+        n += 1
+        w0 = update_weights(w0, switch_sharpness)
+    return w_steps[:n], blend_steps[:n]
 
 
 def reset_weights():
     """
     This function init weights (or different, depending of gradual or abrupt drifts)
-    :return default/initial weight.
+    :return default/initial weight of the current model.
     """
-    w = (1, 0)  # Initialize
-    return w
+    w0 = 1.0  # Initialize
+    return w0
 
 
-def get_event_dict(counter, current_model, new_model, new_switch_type, switch_type, tool_params, w):
-    return {'n_row': counter,
-            'new_switch': new_switch_type.name,
-            'cur_switch': switch_type.name if switch_type.name != 'PREDEFINED'
-            else '_'.join([switch_type.name, str(int(100/(round(tool_params['defined_drift_sharpness'], 3)*100)))]),
-            'weights': w,
-            'current_model_id': current_model.id,  # Add p,o,q to this?
-            'new_model_id': -1 if new_model is None else new_model.id}
+def init_events(size: int):
+    """
+    This function preallocates the columns of the log of events (see EVENT_COLS), filled by 'log_event'.
+    New switches are stored as the value of their type and the weights as the weight of the current model.
+    :param size: max number of events
+    :return: dict of columns
+    """
+    return {'n_row': np.empty(size, dtype=np.int64),
+            'new_switch': np.empty(size, dtype=np.int8),
+            'cur_switch': np.empty(size, dtype=object),
+            'weights': np.empty(size, dtype=np.float64),
+            'current_model_id': np.empty(size, dtype=np.int64),  # Add p,o,q to this?
+            'new_model_id': np.empty(size, dtype=np.int64)}
+
+
+def log_event(events, pos, counter, current_model, new_model, new_switch_type, switch_type, tool_params, w0):
+    """ This function writes an event in the position pos of the log of events. """
+    events['n_row'][pos] = counter
+    events['new_switch'][pos] = new_switch_type.value
+    events['cur_switch'][pos] = switch_type.name if switch_type.name != 'PREDEFINED' \
+        else '_'.join([switch_type.name, str(int(100/(round(tool_params['defined_drift_sharpness'], 3)*100)))])
+    events['weights'][pos] = w0
+    events['current_model_id'][pos] = current_model.id
+    events['new_model_id'][pos] = -1 if new_model is None else new_model.id
+
+
+def get_events_frame(events, n_events: int):
+    """
+    This function returns the first n_events of the log of events as a dataframe,
+    with the names of the switches and the weights as (current, new) pairs.
+    """
+    w0 = events['weights'][:n_events]
+    rc = {col: events[col][:n_events] for col in EVENT_COLS}
+    rc['new_switch'] = SWITCH_NAMES[rc['new_switch'] + 1]
+    rc['weights'] = list(zip(w0.tolist(), (1.0 - w0).tolist()))
+    return pd.DataFrame(rc, columns=EVENT_COLS)
 
 
-def random_switch(switch_prob: float, abrupt_prob: float):
+def random_switch(switch_draw: float, abrupt_draw: float, switch_prob: float, abrupt_prob: float):
     """
     This function flips coins and return if a drift should be triggered and its type.
+    :param switch_draw: uniform draw for the switch coin (drawn up-front in 'switching_process')
+    :param abrupt_draw: uniform draw for the type of switch
     :param switch_prob
     :param abrupt_prob
     :return switch event that takes in place. integer represented by an enum.
     """
-    if random.random() < switch_prob:
+    if switch_draw < switch_prob:
         # Switch ?
-        if random.random() < abrupt_prob:
+        if abrupt_draw < abrupt_prob:
             return Switch.ABRUPT
         else:
             return Switch.GRADUAL
@@ -263,9 +535,13 @@ def random_switch(switch_prob: float, abrupt_prob: float):
         return Switch.NONE
 
 
-def start_switch(counter, conf):
+def start_switch(counter, conf, switch_draws, abrupt_draws):
     """
     This function manages the decision of switching from one model to another.
+    :param counter: current iteration
+    :param conf: tool params
+    :param switch_draws: uniform draws (one per iteration) for random switches
+    :param abrupt_draws: uniform draws (one per iteration) for the type of random switches
     """
     conf['defined_drift_sharpness'] = None
 
@@ -287,17 +563,21 @@ def start_switch(counter, conf):
                 return new_switch_type, switch_shp, conf, switch_to
     else:
         # No new switch if there is one already in progress
-        new_switch_type = random_switch(conf['switching_probability'], conf['abrupt_drift_prob'])
+        new_switch_type = random_switch(switch_draws[counter], abrupt_draws[counter],
+                                        conf['switching_probability'], conf['abrupt_drift_prob'])
 
     switch_shp = [conf['gradual_drift_sharpness'], conf['abrupt_drift_sharpness'], conf['defined_drift_sharpness']]
     return new_switch_type, switch_shp, conf, None
 
 
-def get_new_model(current_id: int, config: dict()):
+def get_new_model(current_id: int, config: dict(), offset: int = None, rng: np.random.Generator = None):
     """
     This function picks a new model based in their probability to be selected (equal for all by now).
+    The new id is the current one shifted by an offset in [1, N-1] (modulo N), so it is never repeated.
     :param current_id - so there is an actual drift and the id is not repeated.
     :param config - for probabilities
+    :param offset - draw in [1, N-1] (drawn here if not given)
+    :param rng - random generator for the offset (a new one if not given)
     :return new model id
     """
     # NOT TO BE DEVELOPED (YET)
@@ -305,11 +585,16 @@ def get_new_model(current_id: int, config: dict()):
     # for i in range(len(config)):
     # for i in range(len(config)):
     #     config[i][1]  # TOD: ENUMERATOR SO TRANSITION_PROBABILITIES_POS == 1
-    new_model_id = random.randrange(1, len(config)+1)
-    return get_new_model(current_id, config) if current_id == new_model_id else new_model_id
+    n_models = len(config)
+    if n_models < 2:
+        raise ValueError('At least two series are needed to switch between models.')
+    if offset is None:
+        offset = (np.random.default_rng() if rng is None else rng).integers(1, n_models)
+    return ((current_id - 1 + offset) % n_models) + 1
 
 
-def switching_process(tool_params: dict(), models: dict(), data_config: dict(), armagarch_lib, show_plt: bool):
+def switching_process(tool_params: dict(), models: dict(), data_config: dict(), armagarch_lib, show_plt: bool,
+                      rng: np.random.Generator = None):
     """
     This function computes transitions between time series and returns the resulting time series.
     :param tool_params: info regarding to stitches from yaml file
@@ -317,6 +602,8 @@ def switching_process(tool_params: dict(), models: dict(), data_config: dict(),
     :param data_config: datasets info from yaml file
     :param show_plt: plot resulting ts?
     :param armagarch_lib: TSpackage for R library to use
+    :param rng: random generator of the switches and of the simulations of the models
+                (seeded with tool_params.get('seed') if not given)
     :return: ts - series generated
     :rerurn: rc - dataframe of events (switches flagged, models used and weights)
     """
@@ -329,14 +616,27 @@ def switching_process(tool_params: dict(), models: dict(), data_config: dict(),
     current_model = models[f'{MODEL_DICT_NAMES}{1}']  # first model -> current_model = A (randomly chosen)
     new_model = None
 
-    # Initialize main series
-    ts = list()  # rec_ts = list()
-    rc = list()
-    w = reset_weights()  # tuple (current, new) of model weights.
-    sig_w = reset_weights()
+    # Initialize main series (preallocated, n is the position of the next value to write)
+    ts = np.empty(tool_params['periods'], dtype=np.float64)  # rec_ts = list()
+    n = 0
+    rc = init_events(tool_params['periods'])  # log of events (at most one per iteration)
+    n_events = 0
+    w0 = reset_weights()  # weight of the current model (the new model gets 1 - w0).
+    blend_w0 = reset_weights()  # weight applied to its forecasts (w0 after the sigmoid kernel, if used)
+    switch_w, switch_blend_w, switch_step = None, None, 0  # weights of each step of the current switch
+    switch_old_forecasts = None  # forecasts of the current model for each step of the current switch
     state_counter = 0
 
+    # Random switches (and the models to switch to) are drawn up-front from a single generator,
+    # so the number of steps till the next one is known in advance
+    rng = np.random.default_rng(tool_params.get('seed')) if rng is None else rng
+    switch_draws = rng.random(tool_params['periods'])
+    abrupt_draws = rng.random(tool_params['periods'])
+    new_model_offsets = rng.integers(1, max(2, len(data_config['files'])), size=tool_params['periods'])
+    switch_its = np.flatnonzero(switch_draws < tool_params['switching_probability'])
+
     logging.info('Start of the context-switching generative process:')
+    log_periods = logger.isEnabledFor(logging.DEBUG)  # the values generated are only logged in debug mode
     it_counter = aux_current_it_counter = 0
     while it_counter < tool_params['periods']:
         # print(it_counter)
@@ -344,22 +644,30 @@ def switching_process(tool_params: dict(), models: dict(), data_config: dict(),
         # 1 Start forecasting in 1 step horizons using the current model
         n_steps = 1
         new_switch_type, new_switch_shp, tool_params, switch_to = no_switch \
-            if (0 < w[1] < 1 or state_counter <= tool_params['min_model_len']) \
-            else start_switch(it_counter, tool_params)
+            if (0 < w0 < 1 or state_counter <= tool_params['min_model_len']) \
+            else start_switch(it_counter, tool_params, switch_draws, abrupt_draws)
 
-        # using transitions map and not during drift, n_steps = 'steps till next drift'
+        # not during drift, n_steps = 'steps till next drift' (from the transitions map or the random draws)
         # print(f'TMAP: {tool_params["use_transition_map"]}  w:'
-        #       f'{w[0]} '
+        #       f'{w0} '
         #       f'IT_COUNTER: {it_counter}')
-        # print(w[0])
-
-        if (tool_params['use_transition_map']) & (w[0] == 1) & (new_switch_type.value < 0):
-            # andres: This last condition below shouldn't be in place,
-            # but it helps controlling the first model from over predicting and
-            # therefore control the obtained results through the whole execution.
-            # & (it_counter >= max(current_model.get_lags())):
-            next_drift = get_next_switch(it_counter, tool_params)
-            next_fcst_horizon = next_drift if it_counter < next_drift else tool_params['periods']
+        # print(w0)
+
+        if (w0 == 1) & (new_switch_type.value < 0):
+            if tool_params['use_transition_map']:
+                # andres: This last condition below shouldn't be in place,
+                # but it helps controlling the first model from over predicting and
+                # therefore control the obtained results through the whole execution.
+                # & (it_counter >= max(current_model.get_lags())):
+                next_drift = get_next_switch(it_counter, tool_params)
+                # the map can go on after the last period
+                next_fcst_horizon = min(next_drift, tool_params['periods']) if it_counter < next_drift \
+                    else tool_params['periods']
+            else:
+                # The first iteration where the current model has been used for long enough to switch
+                next_fcst_horizon = min(get_next_random_switch(
+                    it_counter + max(1, tool_params['min_model_len'] + 1 - state_counter), switch_its, tool_params),
+                    tool_params['periods'])
             if it_counter < next_fcst_horizon:
                 n_steps = next_fcst_horizon - it_counter
                 it_counter = next_fcst_horizon - 1
@@ -367,15 +675,16 @@ def switching_process(tool_params: dict(), models: dict(), data_config: dict(),
 
         # print(f'N_STEPS: {n_steps}  IT_COUNTER: {it_counter}')
         # print(it_counter)
-        # print(w[0])
-        old_model_forecast = current_model.forecast(list(current_model.input_ts)
-                                                    # Before the time series cover the minimum length of the
-                                                    # time series, the model simulates  over it's input series
-                                                    if aux_current_it_counter >= (max(current_model.get_lags()) + 1)
-                                                    else list(current_model.input_ts),
-                                                    armagarch_lib,
-                                                    tool_params['roll_window_size'],
-                                                    n_steps)  # *  current_model.multiplier
+        # print(w0)
+        # The current model simulates over it's input series (see the note on over predicting above).
+        # During a switch, its forecasts of all the steps are simulated at once when the switch starts (see 2).
+        if 0 < w0 < 1:
+            old_model_forecast = switch_old_forecasts[switch_step:switch_step + 1]
+        elif new_switch_type.value < 0:
+            old_model_forecast = current_model.forecast(current_model.input_ts_array,
+                                                        armagarch_lib,
+                                                        tool_params['roll_window_size'],
+                                                        n_steps, rng=rng)  # *  current_model.multiplier
 
         # 2 In case of switch, select a new model and reset weights: (1.0, 0.0) at the start (no changes) by default.
         if new_switch_type.value >= 0:
@@ -384,53 +693,83 @@ def switching_process(tool_params: dict(), models: dict(), data_config: dict(),
             switch_type, switch_shp = new_switch_type, new_switch_shp
             # print(f'switch sharpness: {switch_shp}')
             # 'switch_to' is only used if transition_maps are enabled.
-            new_mdl_number = get_new_model(current_model.id, data_config["files"]) if switch_to is None else switch_to
+            new_mdl_number = switch_to if switch_to is not None \
+                else get_new_model(current_model.id, data_config["files"], int(new_model_offsets[it_counter]))
             new_model = models[f'{MODEL_DICT_NAMES}{new_mdl_number}']
             # print(f'switch_type.value: {switch_type.value}')
 
-            w = update_weights(w=reset_weights(), switch_sharpness=switch_shp[switch_type.value])
-            sig_w = (gutils.get_sigmoid()[int(w[0]*100)], 1 - gutils.get_sigmoid()[int(w[0]*100)])  # kernel to sig func
+            if switch_shp[switch_type.value] < MIN_SWITCH_SHARPNESS:
+                warnings.warn(f'Minimum switch abrupcy is {MIN_SWITCH_SHARPNESS}, so this is the value being used.')
+            switch_w, switch_blend_w = get_switch_weights(switch_shp[switch_type.value], use_sig_w, SIGMOID_LUT)
+            switch_step = 0
+            if len(switch_w) == 0:
+                # Instant switch (e.g. a PREDEFINED one of length 0): the new model takes over from this step
+                w0 = blend_w0 = 0.0
+                old_model_forecast = new_model.forecast(new_model.input_ts_array,
+                                                        armagarch_lib,
+                                                        tool_params['roll_window_size'], rng=rng)
+            else:
+                w0, blend_w0 = float(switch_w[0]), float(switch_blend_w[0])
+                # One step ahead of the same input series for each step of the switch, as independent simulations
+                switch_old_forecasts = current_model.forecast(current_model.input_ts_array,
+                                                              armagarch_lib,
+                                                              tool_params['roll_window_size'],
+                                                              m_sim=len(switch_w), rng=rng)
+                old_model_forecast = switch_old_forecasts[:1]
+                if __debug__:  # checked once per switch, and not at all with python -O
+                    assert len(switch_old_forecasts) == len(switch_w), \
+                        'There should be one forecast of the current model per step of the switch'
+                    assert np.all((0 <= switch_blend_w) & (switch_blend_w <= 1)), 'Weights should be in [0, 1]'
 
         # 3 Log switches and events
-        rc.append(get_event_dict(aux_current_it_counter, current_model, new_model,
-                                 new_switch_type, switch_type, tool_params,
-                                 sig_w if use_sig_w else w))
-        assert (sig_w[0] + sig_w[1] if use_sig_w else w[0] + w[1]) == 1
+        log_event(rc, n_events, aux_current_it_counter, current_model, new_model,
+                  new_switch_type, switch_type, tool_params, blend_w0)
+        n_events += 1
+        if w0 == 0:  # instant switch, logged above with the new model
+            current_model = new_model
+            new_model = None
+            state_counter = 0
+            w0 = reset_weights()
+            blend_w0 = reset_weights()
+            switch_type = Switch.NONE
 
         # 4 if it's switching (started now or in other iteration), then forecast with new model and get weighted average
-        if 0 < w[1] < 1:
+        if 0 < w0 < 1:
             # print('Update weights:')
             # Forecast and expand current series (current model is the old one, this becomes current when weight == 1)
-            new_model_forecast = new_model.forecast(list(new_model.input_ts)
-                                                        if aux_current_it_counter < max(new_model.get_lags())
-                                                        else list(ts),
+            # The series generated so far is only used once it is longer than the lags of the new model,
+            # so there is at least one residual to start its variance from
+            new_model_forecast = new_model.forecast(new_model.input_ts_array
+                                                    if n <= new_model.max_lag
+                                                    else ts[:n],  # view of the series generated so far
                                                     armagarch_lib,
-                                                    tool_params['roll_window_size'])  # * new_model.multiplier
-
-            assert len(old_model_forecast) == 1 & len(new_model_forecast) == 1, \
-                'Lenght of forec' \
-                'asts shouldn\'t be greater than 1 during a switch'
-            ts.append(old_model_forecast[0] * (sig_w[0] if use_sig_w else w[0]) +
-                      new_model_forecast[0] * (sig_w[1] if use_sig_w else w[1]))
-            # ts.append(np.mean([old_model_forecast[0] * (sig_w[0] if use_sig_w else w[0]),
-            #                   new_model_forecast[0] * (sig_w[1] if use_sig_w else w[1])]))
-
-            w = update_weights(w, switch_shp[switch_type.value])
-            sig_w = (gutils.get_sigmoid()[int(w[0]*100)], 1 - gutils.get_sigmoid()[int(w[0]*100)])  # kernel to sig func
-            # print(sig_w)
-
-            if w[1] == 1:
+                                                    tool_params['roll_window_size'], rng=rng)  # * new_model.multiplier
+
+            ts[n] = old_model_forecast[0] * blend_w0 + new_model_forecast[0] * (1.0 - blend_w0)
+            n += 1
+            # ts.append(np.mean([old_model_forecast[0] * (sig_w[0] if use_sig_w else w0),
+            #                   new_model_forecast[0] * (sig_w[1] if use_sig_w else 1 - w0)]))
+
+            # Weights of the next step, precomputed at the start of the switch
+            switch_step += 1
+            if switch_step < len(switch_w):
+                w0, blend_w0 = float(switch_w[switch_step]), float(switch_blend_w[switch_step])
+            else:
+                w0 = 0.0
+            # print(blend_w0)
+
+            if w0 == 0:
                 current_model = new_model
                 new_model = None
                 state_counter = 0  # reset of counter for duration of model
-                w = reset_weights()
-                sig_w = reset_weights()
+                w0 = reset_weights()
+                blend_w0 = reset_weights()
                 switch_type = Switch.NONE
 
                 # ####################
                 # Export current state
                 # ####################
-                tsa = pd.DataFrame(ts)
+                tsa = pd.DataFrame(ts[:n])
                 tsa.plot()
                 # plt.show()
                 plt.savefig(f"logs/output_ret_{timestamp}.png")
@@ -446,26 +785,27 @@ def switching_process(tool_params: dict(), models: dict(), data_config: dict(),
 
         # 5. Otherwise, use the current forecast
         else:
-            i = 1
-            for om_fcst_pos in (old_model_forecast * current_model.multiplier):
-                ts.append(om_fcst_pos)
-                if i < len(old_model_forecast):  # not logging last pos as it gets logged after this (to avoid logging repeated values)
-                    logging.info(f':{om_fcst_pos}')
-                i += 1
-                # print(om_fcst_pos)
+            om_fcst = old_model_forecast[:tool_params['periods'] - n] * current_model.multiplier
+            ts[n:n + len(om_fcst)] = om_fcst
+            n += len(om_fcst)
+            if log_periods:
+                for om_fcst_pos in om_fcst[:-1]:  # not logging last pos as it gets logged after this (to avoid logging repeated values)
+                    logger.debug(':%s', om_fcst_pos)
+                    # print(om_fcst_pos)
         # if len(ts) % 100 == 0:
         # print(f'len {len(ts)}:: {ts[-1]}')
         state_counter = state_counter + 1
         it_counter = it_counter + 1
         aux_current_it_counter = it_counter
-        logging.info(f'Period {it_counter}:{ts[-1]}')
+        if log_periods:
+            logger.debug('Period %d:%s', it_counter, ts[n - 1])
         # print(f'Period {it_counter}: {ts[-1]}')
 
     # 4 Plot simulations
     if show_plt:
         gutils.plot_results(ts)
 
-    return pd.Series(ts),  pd.DataFrame(rc)
+    return pd.Series(ts[:n]),  get_events_frame(rc, n_events)
 
 
 def get_next_switch(it_counter, tool_params):
@@ -479,7 +819,16 @@ def get_next_switch(it_counter, tool_params):
     return next_drift
 
 
-def prepare_and_export(global_params, output_format, rc, ts, reconstruction_price):
+def get_next_random_switch(it_counter, switch_its, tool_params):
+    """ This function receives the iterations where random switches are drawn (ascending) and returns the next one
+    :param it_counter: first iteration where a switch can be triggered
+    :param switch_its: iterations where the coin-flip for a switch succeeds
+    :param tool_params: dictionary that contains the number of periods"""
+    pos = np.searchsorted(switch_its, it_counter)
+    return int(switch_its[pos]) if pos < len(switch_its) else tool_params['periods']
+
+
+def prepare_and_export(global_params, output_format, rc, ts, reconstruction_price, rng=None):
     """
         This function reconstruct prices, adds noise and and exports a csv
         :param global_params: config params
@@ -487,34 +836,34 @@ def prepare_and_export(global_params, output_format, rc, ts, reconstruction_pric
         :param rc: registered events
         :param ts: time series generated
         :param reconstruction_price: price for reconstruction
+        :param rng: random generator of the noise
         :return:
     """
     logging.info('Reconstructing prices and adding noise...')
-    rc['ret_ts'] = ts
+    # The new columns are computed first and added to rc at once
 
     # 5.1 noise over returns
-    ts_gn, ts_snr = gutils.add_noise(global_params['white_noise_level'], list(rc['ret_ts']))
+    ts_gn, ts_snr = gutils.add_noise(global_params['white_noise_level'], ts.to_numpy(dtype=np.float64), rng)
 
     # 5.2 reconstruction
-    rc['ts'] = gutils.reconstruct(ts, init_val=reconstruction_price)
-    # rc['ts_mult'] = gutils.reconstruct(ts * 5, init_val=reconstruction_price)
-    # Gaussian noise & reconstruct
-    rc['ts_n1_pre'] = gutils.reconstruct(ts_gn, init_val=reconstruction_price)
-    # SNR and White Gaussian Noise & reconstruct
-    rc['ts_n2_pre'] = gutils.reconstruct(ts_snr, init_val=reconstruction_price)
+    rec_ts = gutils.reconstruct(ts, init_val=reconstruction_price)
+    # ts_mult = gutils.reconstruct(ts * 5, init_val=reconstruction_price)
 
     # 5.3 noise post-reconstruction (over prices)
-    ts_gn, ts_snr = gutils.add_noise(global_params['white_noise_level'], list(rc['ts']))
-    rc['ts_n1_post'] = ts_gn  # Gaussian noise
-    rc['ts_n2_post'] = ts_snr  # SNR and White Gaussian Noise
+    rec_gn, rec_snr = gutils.add_noise(global_params['white_noise_level'], rec_ts.to_numpy(dtype=np.float64), rng)
+    rc = rc.assign(ret_ts=ts, ts=rec_ts,
+                   ts_n1_pre=gutils.reconstruct(ts_gn, init_val=reconstruction_price),  # Gaussian noise & reconstruct
+                   ts_n2_pre=gutils.reconstruct(ts_snr, init_val=reconstruction_price),  # SNR and WGN & reconstruct
+                   ts_n1_post=rec_gn,  # Gaussian noise
+                   ts_n2_post=rec_snr)  # SNR and White Gaussian Noise
 
     # 6 Final simulation (TS created) and a log of the regime changes (RC) to CSV files
     rc[output_format['cols']].to_csv(os.sep.join([output_format['path'],
                                                   output_format['ts_name'] + str(timestamp) + '.csv']),
-                                     index=False)
+                                     index=False, chunksize=100_000)  # written by chunks to cap memory
 
 
-def prepare_and_export_2(global_params, output_format, rc, ts, reconstruction_price):
+def prepare_and_export_2(global_params, output_format, rc, ts, reconstruction_price, rng=None):
     """
     This function reconstruct prices, adds noise and and exports a csv
     :param global_params: config params
@@ -522,31 +871,30 @@ def prepare_and_export_2(global_params, output_format, rc, ts, reconstruction_pr
     :param rc: registered events
     :param ts: time series generated
     :param reconstruction_price: price for reconstruction
+    :param rng: random generator of the noise
     :return:
     """
     logging.info('Reconstructing prices and adding noise...')
-    rc['ret_ts'] = ts
+    # The new columns are computed first and added to rc at once
 
     # 5.1 noise over returns
-    ts_gn, ts_snr = gutils.add_noise(global_params['white_noise_level'], list(rc['ret_ts']))
+    ts_gn, ts_snr = gutils.add_noise(global_params['white_noise_level'], ts.to_numpy(dtype=np.float64), rng)
 
     # 5.2 reconstruction
-    rc['ts'] = gutils.reconstruct(ts, init_val=reconstruction_price)
-
-    # Gaussian noise & reconstruct
-    rc['ts_n1_pre'] = gutils.reconstruct(ts_gn, init_val=reconstruction_price)
-    # SNR and White Gaussian Noise & reconstruct
-    rc['ts_n2_pre'] = gutils.reconstruct(ts_snr, init_val=reconstruction_price)
+    rec_ts = gutils.reconstruct(ts, init_val=reconstruction_price)
 
     # 5.3 noise post-reconstruction (over prices)
-    ts_gn, ts_snr = gutils.add_noise(global_params['white_noise_level'], list(rc['ts']))
-    rc['ts_n1_post'] = ts_gn  # Gaussian noise
-    rc['ts_n2_post'] = ts_snr  # SNR and White Gaussian Noise
+    rec_gn, rec_snr = gutils.add_noise(global_params['white_noise_level'], rec_ts.to_numpy(dtype=np.float64), rng)
+    rc = rc.assign(ret_ts=ts, ts=rec_ts,
+                   ts_n1_pre=gutils.reconstruct(ts_gn, init_val=reconstruction_price),  # Gaussian noise & reconstruct
+                   ts_n2_pre=gutils.reconstruct(ts_snr, init_val=reconstruction_price),  # SNR and WGN & reconstruct
+                   ts_n1_post=rec_gn,  # Gaussian noise
+                   ts_n2_post=rec_snr)  # SNR and White Gaussian Noise
 
     # 6 Final simulation (TS created) and a log of the regime changes (RC) to CSV files
     rc[output_format['cols']].to_csv(os.sep.join([output_format['path'],
                                                   output_format['ts_name'] + str(timestamp) + '.csv']),
-                                     index=False)
+                                     index=False, chunksize=100_000)  # written by chunks to cap memory
 
 
 def compute():
@@ -560,48 +908,53 @@ def compute():
     # 0 Read from YAML file
     input_data_config, global_params, output_format, armagarch_lib, plt_flag = parse_yaml()
 
-    # 1 Get dict of series and their probabilities calling instantiate_models.
-    #   The objects in this dictionary contain series of returns on log scale.
-    # 2 Then, pre-train GARCH models by looking at different series
-    models_dict = fit_models(series_dict=instantiate_models(input_data_config=input_data_config, show_plt=plt_flag),
-                             input_data_conf=input_data_config,
-                             params=global_params, armagarch_lib=armagarch_lib, show_plt=plt_flag)
-
-    # Generate n sets with the models trained
-    initial_log = log_filename
-    for it in range(global_params['simulations']):
-        try:
-            # Logger
-            print(f'[START] - Iteration - {it} - for output_{timestamp}.log')
-            logging.info(f'Iteration {it} - Fitting and config in initial log: {initial_log}')
-            # 3 Once the models are pre-train, these are used for simulating the final series.
-            # At every switch, the model that generates the final time series will be different.
-            ts, rc = switching_process(tool_params=global_params, models=models_dict,
-                                       data_config=input_data_config, armagarch_lib=armagarch_lib, show_plt=plt_flag)
-
-            # 4 Plot simulations
-            if plt_flag:
-                gutils.plot_results(ts)
-
-            # 5 Add noise (gaussian noise and SNR) pre-reconstruction, reconstruct prices and add noise post-reconstruction
-            # 6 and export
-            rc.index = rc['n_row'].astype(int)
-            rc = rc.reindex(range(global_params['periods'])).ffill()
-            rc['n_row'] = np.arange(len(rc))
-            # pc = rc.copy()
-            # pc['ret_ts'] = ts
-            # pc.to_csv(os.sep.join([output_format['path'], output_format['ts_name'] + str(int(time.time())) + '.csv']),
-            #           index=False)
-            # 6 Final simulation (TS created) and a log of the regime changes (RC) to CSV files
-            prepare_and_export(global_params, output_format, rc, ts,
-                               reconstruction_price=models_dict['fitted_1'].rec_price)
-            print(f'[SUCCESS] Iteration - {it} - for output_{timestamp}.log')
-
-        except Exception as e:
-            print(f'[CRASHED] - Iteration - {it} - for output_{timestamp}.log')
-            print(e)
-
-        set_globals()  # create new logs
+    # The fitted models that are not cached are removed once all the sets are generated
+    with tempfile.TemporaryDirectory(prefix=MODEL_DICT_NAMES) as tmp_dir:
+        # 1 Get dict of series and their probabilities calling instantiate_models.
+        #   The objects in this dictionary contain series of returns on log scale.
+        # 2 Then, pre-train GARCH models by looking at different series
+        series_dict = instantiate_models(input_data_config=input_data_config, show_plt=plt_flag)
+        models_dict = fit_models(series_dict=series_dict, input_data_conf=input_data_config,
+                                 params=global_params, armagarch_lib=armagarch_lib, show_plt=plt_flag, tmp_dir=tmp_dir)
+
+        # Generate n sets with the models trained.
+        # A single generator for all of them, so a seed reproduces the whole run and each set is still different.
+        rng = np.random.default_rng(global_params.get('seed'))
+        initial_log = log_filename
+        for it in range(global_params['simulations']):
+            try:
+                # Logger
+                print(f'[START] - Iteration - {it} - for output_{timestamp}.log')
+                logging.info(f'Iteration {it} - Fitting and config in initial log: {initial_log}')
+                # 3 Once the models are pre-train, these are used for simulating the final series.
+                # At every switch, the model that generates the final time series will be different.
+                ts, rc = switching_process(tool_params=global_params, models=models_dict,
+                                           data_config=input_data_config, armagarch_lib=armagarch_lib,
+                                           show_plt=plt_flag, rng=rng)
+
+                # 4 Plot simulations
+                if plt_flag:
+                    gutils.plot_results(ts)
+
+                # 5 Add noise (gaussian noise and SNR) pre-reconstruction, reconstruct prices and add noise post-reconstruction
+                # 6 and export
+                rc.index = rc['n_row'].astype(int)
+                rc = rc.reindex(range(global_params['periods'])).ffill()
+                rc['n_row'] = np.arange(len(rc))
+                # pc = rc.copy()
+                # pc['ret_ts'] = ts
+                # pc.to_csv(os.sep.join([output_format['path'], output_format['ts_name'] + str(int(time.time())) + '.csv']),
+                #           index=False)
+                # 6 Final simulation (TS created) and a log of the regime changes (RC) to CSV files
+                prepare_and_export(global_params, output_format, rc, ts,
+                                   reconstruction_price=models_dict['fitted_1'].rec_price, rng=rng)
+                print(f'[SUCCESS] Iteration - {it} - for output_{timestamp}.log')
+
+            except Exception as e:
+                print(f'[CRASHED] - Iteration - {it} - for output_{timestamp}.log')
+                print(e)
+
+            set_globals()  # create new logs
 
 
 def reconstruct(filename: str):
@@ -609,18 +962,19 @@ def reconstruct(filename: str):
 
     # Read YAML file
     with open("config.yaml", 'r') as stream:
-        config = yaml.safe_load(stream)
+        config = yaml.load(stream, Loader=YAMLLoader)
         input_data_config = config['input']
         global_params = config['params']
         out_format = config['output']
-        armagarch_lib = {'lib': 'rugarch', 'env': config['env']['r_libs_path']}
+        armagarch_lib = {'lib': config['env'].get('armagarch_lib', 'rugarch'), 'env': config['env']['r_libs_path']}
 
     df = pd.read_csv(os.sep.join([out_format['path'], filename]))
     # models_dict['fitted_1']  # -> 227.52
     # models_dict['fitted_2']  # -> 10850.26
     # models_dict['fitted_3']  # -> 0.3199
     # models_dict['fitted_4']  # -> 164.91
-    prepare_and_export_2(global_params, out_format, rc=df, ts=df.ret_ts, reconstruction_price=227.52)
+    prepare_and_export_2(global_params, out_format, rc=df, ts=df.ret_ts, reconstruction_price=227.52,
+                         rng=np.random.default_rng(global_params.get('seed')))
 
 
 def set_globals():
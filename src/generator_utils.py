@@ -2,11 +2,18 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 import math
+from functools import lru_cache
 import statsmodels.api as sm
 import statsmodels.tsa.api as smt
 import scipy.stats as scs
 import multiprocessing
+import joblib
 from sklearn.preprocessing import MinMaxScaler
+try:
+    from numba import njit
+except ImportError:  # numba is optional, the kernels decorated with njit run as plain Python without it
+    def njit(*args, **kwargs):
+        return args[0] if len(args) == 1 and callable(args[0]) else (lambda func: func)
 
 TIME_HORIZON = 1  # fixed / static TODO
 
@@ -92,43 +99,92 @@ def sigmoid(x):
     return 1 / (1 + np.exp(-x))
 
 
+@lru_cache(maxsize=None)
 def get_sigmoid():
+    """
+    Lookup table of the sigmoid kernel applied to the weights of a switch (indexed as int(w0 * 100)).
+    It is computed once and shared, so it is read-only.
+    """
     x = np.linspace(-5, 5, 100)  # for sigmoid
-    return sigmoid(x)
+    sig = sigmoid(x)
+    sig.setflags(write=False)
+    return sig
 
 
 def reconstruct(ts: float, init_val: float):
     """
     This function reconstructs the initial series, as the models are trained with returns/deltas in log scale.
+    The cumulative sum, exponential and scaling are computed in place over a single copy of the series.
     :param new_model_forecast - forecast as a return and in log scale
     :param new_model_forecast - forecast as a return and in log scale
     :param init_value - initial value of the current series for the reconstruction
-    :return: forecast reconstructed.
+    :return: forecast reconstructed (same type, index and columns as ts).
     """
     # return init_value * np.exp(ts[TIME_HORIZON - 1] * -1)
-    return init_val * np.exp(np.cumsum(ts))  # * -1))
-
-
-def add_noise(noise_level: float, ts: list()):
+    rec = np.array(ts, dtype=np.float64)
+    nan = np.isnan(rec)  # NaNs are skipped by the cumulative sum (as in pandas) and kept in place
+    rec[nan] = 0
+    np.cumsum(rec, axis=0, out=rec)
+    np.exp(rec, out=rec)  # * -1))
+    rec *= init_val
+    rec[nan] = np.nan
+    if isinstance(ts, pd.DataFrame):
+        return pd.DataFrame(rec, index=ts.index, columns=ts.columns)
+    if isinstance(ts, pd.Series):
+        return pd.Series(rec, index=ts.index, name=ts.name)
+    return rec
+
+
+def add_noise(noise_level: float, ts: np.ndarray, rng: np.random.Generator = None):
     """
     This function adds noise to the time series passed as a parameter.
     :param noise_level: percentage representing level of noise to be added
-    :param ts: time series generated
+    :param ts: time series generated (array of floats)
+    :param rng: random generator (a new one if not given)
     :return time series with added noise
     """
-    t = np.linspace(-20, 20, len(ts))
+    ts = np.asarray(ts, dtype=np.float64)
+    rng = np.random.default_rng() if rng is None else rng
     snr = 10 * np.log(1 + noise_level)  # SNR = 0.487 for noise_level = 0.05
 
     # Random N - length vector of Gaussian numbers
-    r = np.random.randn(1, len(t))
+    r = rng.standard_normal(len(ts))
 
     # 6.1 Add noise using (noise_level)% Gaussian Noise Method
-    ts_n1 = pd.Series((ts + noise_level * r * ts)[0])  # Noisy signal
+    ts_n1 = np.multiply(ts, r)
+    ts_n1 *= noise_level
+    ts_n1 += ts  # Noisy signal
 
     # 6.2 Add noise using (10 * np.log(1 + noise_level)) SNR and White Gaussian Noise
-    ts_n2 = pd.Series((ts + np.sqrt((10 ** (-snr / 10))) * r)[0])  # Noisy signal
+    ts_n2 = np.multiply(r, np.sqrt(10 ** (-snr / 10)))
+    ts_n2 += ts  # Noisy signal
+
+    return pd.Series(ts_n1), pd.Series(ts_n2)
+
+
+def get_chunksize(n_tasks: int, n_proc: int):
+    """
+    This function returns how many tasks are sent at once to each worker of a pool of processes.
+    Sending a few tasks per message reduces the pickling and dispatching overhead of sending them one by one.
+    :param n_tasks: number of tasks mapped
+    :param n_proc: number of processes in the pool
+    :return: chunksize
+    """
+    return max(1, n_tasks // (n_proc + 2))
+
+
+class LazyModelDict(dict):
+    """
+    Dictionary of the paths where the workers of 'fit_models' store the fitted models.
+    Each model is loaded from its file the first time it is accessed, and kept in the dictionary from then on.
+    """
 
-    return ts_n1, ts_n2
+    def __getitem__(self, key):
+        value = super(LazyModelDict, self).__getitem__(key)
+        if isinstance(value, str):
+            value = joblib.load(value)
+            self[key] = value
+        return value
 
 
 # Helper wrapper to create non-daemonic processes in the pool of parallel processes so these can still be split.
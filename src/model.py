@@ -5,6 +5,7 @@ import multiprocessing
 from functools import partial
 from dataclasses import dataclass
 from sklearn import metrics
+from src.backends import ArchBackend
 
 
 # RPY packages to run rugarch in python
@@ -28,6 +29,20 @@ get_spec = robjects.r('''function(fitted) {
                                 return(spec)
                              }''')
 
+# Native Python alternative to rugarch (lib: 'arch' in config.yaml)
+ARCH_BACKEND = ArchBackend()
+
+
+def init_rlib(lib_conf):
+    """
+    This function loads the R library for ARMA-GARCH once per process (e.g. as initializer of a pool of workers),
+    so the models fitted in that process do not import it again.
+    :param lib_conf: TSpackage for R library to use
+    """
+    if lib_conf['lib'] != 'arch':
+        Model.rugarch_lib_instance = importr(lib_conf['lib'], lib_conf['env'])
+
+
 @dataclass
 class Model:
     rugarch_lib_instance = None
@@ -53,6 +68,10 @@ class Model:
     ARMAGARCHspec = None
     ARMAGARCHfitted = None
 
+    # Cached once fitted (see fit_model in generator.py)
+    input_ts_array = None  # input_ts as a contiguous array of floats
+    max_lag = 0  # max(get_lags()), set by set_lags
+
     """ 
     This function sets the fitted parameters in a rugarch spec. 
     @:param fitted: fitted model
@@ -99,6 +118,7 @@ class Model:
         self.q = q_
         self.g_p = g_p_
         self.g_q = g_q_
+        self.max_lag = max(self.get_lags())  # cached, as the lags only change here
 
     # def load_preconf(self):
     #     """ This function sets p, o, q for ARMA and GARCH if preloaded (distint from 0). """
@@ -125,6 +145,8 @@ class Model:
         :param lib_conf: TSpackage for R library to use
         :return: trained/fitted model
         """
+        if lib_conf['lib'] == 'arch':
+            return self.fit_arch(current_series, p_, q_, garch_param1, garch_param2)
 
         try:
             # Initialize R GARCH model
@@ -160,12 +182,39 @@ class Model:
 
         return model
 
-    def get_best(self, current_series, conf, lib_conf):
+    def fit_arch(self, current_series, p_=1, q_=1, garch_param1=1, garch_param2=1):
+        """
+        This function uses the Python 'arch' library to fit an AR-GARCH model for p (no MA lags in 'arch')
+        :param current_series:
+        :param p_: p lags of the best fitted ARMA model.
+        :param q_: q lags of the best fitted ARMA model (ignored).
+        :param garch_param1: garch order 0
+        :param garch_param2: garch order 1
+        :return: trained/fitted model
+        """
+        model = None
+        try:
+            model = ARCH_BACKEND.fit(current_series, p_, q_, garch_param1, garch_param2)
+            self.coef = list(model.params)
+            self.coef_names = list(model.params.index)
+
+            # Same checks than with rugarch (see fit)
+            omega, alpha, beta = ARCH_BACKEND.get_garch_coef(model)
+            assert omega > 0 and alpha > 0 and beta > 0
+            assert alpha + beta < 1
+            self.ARMAGARCHfitted = model  # for simulations
+        except Exception:
+            print(f'Model{model} does not fit for the desired params.')
+
+        return model
+
+    def get_best(self, current_series, conf, lib_conf, n_proc: int = None):
         """
         This function uses rugarch to find the best params for ARMA-GARCH for p, 0, q (d!=0 only in ARIMA-GARCH)
         :param current_series:
         :param conf: tool params
         :param lib_conf: TSpackage for R library to use
+        :param n_proc: max number of processes of the search (one per value of p if not given)
         :return: trained/fitted model
         """
         # If best config pre-loaded, do not search
@@ -175,13 +224,13 @@ class Model:
                                                          p_=p, q_=q, garch_param1=p_g, garch_param2=q_g), self.coef
         else:
             # Fitting in parallel according to the ARMA value 'p'.
-            # pool = multiprocessing.Pool(processes=4)
-            pool = multiprocessing.Pool(processes=conf['pq_rng'])
+            p_values = range(conf['init_p'], conf['pq_rng'] + 1, conf['pq_rng_steps'])
+            n_proc = len(p_values) if n_proc is None else max(1, min(n_proc, len(p_values)))
             # TODO: we may want to change the multiprocessing library so calls to it are more understandable/
             #  can we return objects easily there though?
-            mapped = pool.map(partial(self.param_search, conf, current_series, lib_conf),
-                              range(conf['init_p'], conf['pq_rng'] + 1, conf['pq_rng_steps']))
-            best_models_dict = dict(map(reversed, tuple(mapped)))
+            with multiprocessing.Pool(processes=n_proc) as pool:  # closed once the search is done
+                mapped = pool.map(partial(self.param_search, conf, current_series, lib_conf), p_values)
+            best_models_dict = {p: result for result, p in mapped}
 
             # Retrieving the best result across all threads (each value of p)
             best_aic, best_mdl, best_order, best_coef = self.compute_intermediate_results(best_models_dict)
@@ -203,38 +252,46 @@ class Model:
 
     def param_search(self, conf, current_series, lib_conf, p):
         best_aic, best_order, best_mdl, best_coef = np.inf, None, None, []
-        if self.rugarch_lib_instance is None:
+        use_arch = lib_conf['lib'] == 'arch'
+        if self.rugarch_lib_instance is None and not use_arch:
             self.rugarch_lib_instance = importr(lib_conf['lib'], lib_conf['env'])
         # for q, g_p, g_q in itertools.product(range(1, conf['pq_rng'] + 1),
-        for q, g_p, g_q in itertools.product(range(1, conf['pq_rng'] + 1, conf['pq_rng_steps']),  # range(10, 31),
+        for q, g_p, g_q in itertools.product([0] if use_arch  # MA lags are not used by 'arch'
+                                             else range(1, conf['pq_rng'] + 1, conf['pq_rng_steps']),  # range(10, 31),
                                              range(1, conf['garch_pq_rng'] + 1),
                                              range(1, conf['garch_pq_rng'] + 1)):
             try:
                 # print(f'Trying params: {(i, 0, j, k, h)} on model {self.id}.')
-                # Initialize R GARCH model
-                spec = self.rugarch_lib_instance.ugarchspec(
-                    mean_model=robjects.r(f'list(armaOrder=c({p},{q}), include.mean=T)'),
-                    # Using student T distribution usually provides better fit
-                    variance_model=robjects.r(f'list(garchOrder=c({g_p},{g_q}))'),
-                    distribution_model='sged')  # 'std'
-
-                # Train R GARCH model on returns as %
-                numpy2ri.activate()  # Used to convert training set to R list for model input
-                tmp_mdl = self.rugarch_lib_instance.ugarchfit(
-                    spec=spec,
-                    data=np.array(current_series),
-                    out_sample=1  # remember: the 1st forecast should be reproducible in the reconst.,
-                    # as the real value exists
-                )
-                numpy2ri.deactivate()
+                if use_arch:
+                    tmp_mdl = ARCH_BACKEND.fit(current_series, p, q, g_p, g_q)
+                    coef = list(tmp_mdl.params)
+                    omega, alpha, beta = ARCH_BACKEND.get_garch_coef(tmp_mdl)
+                else:
+                    # Initialize R GARCH model
+                    spec = self.rugarch_lib_instance.ugarchspec(
+                        mean_model=robjects.r(f'list(armaOrder=c({p},{q}), include.mean=T)'),
+                        # Using student T distribution usually provides better fit
+                        variance_model=robjects.r(f'list(garchOrder=c({g_p},{g_q}))'),
+                        distribution_model='sged')  # 'std'
+
+                    # Train R GARCH model on returns as %
+                    numpy2ri.activate()  # Used to convert training set to R list for model input
+                    tmp_mdl = self.rugarch_lib_instance.ugarchfit(
+                        spec=spec,
+                        data=np.array(current_series),
+                        out_sample=1  # remember: the 1st forecast should be reproducible in the reconst.,
+                        # as the real value exists
+                    )
+                    numpy2ri.deactivate()
+                    coef = tmp_mdl.slots['fit'].rx2('coef')
+                    omega, alpha, beta = coef[-5], coef[-4], coef[-3]
                 # Checks - see description of checks in fit function
-                coef = tmp_mdl.slots['fit'].rx2('coef')
-                omega, alpha, beta = coef[-5], coef[-4], coef[-3]
                 cond = omega > 0 and alpha > 0 and beta > 0 and alpha + beta < 1  # print(cond)
                 assert cond
                 print(omega, alpha, beta)
                 # [0 AIC, 1 BIC, 2 Shibata, 3 Hannan - Quinn ]
-                tmp_aic, tmp_bic, tmp_sic, tmp_hic = self.get_infocrit(tmp_mdl)
+                tmp_aic, tmp_bic, tmp_sic, tmp_hic = \
+                    ARCH_BACKEND.get_infocrit(tmp_mdl) if use_arch else self.get_infocrit(tmp_mdl)
                 print(f'Trying params: {(p, 0, q, g_p, g_q)} on model {self.id} - '
                       f'AIC: {tmp_aic:6.5f} | BIC: {tmp_bic:6.5f} | SIC: {tmp_sic:6.5f} | HQIC: {tmp_hic:6.5f}')
                 self.param_log.append(f'{self.id};{p};{tmp_aic};{tmp_bic};{tmp_sic};{tmp_hic};{coef};PATH_MODEL_{self.id}_HERE;0')
@@ -263,14 +320,17 @@ class Model:
         self.rugarch_lib_instance = None
         return {'aic': best_aic, 'mdl': best_mdl, 'order': best_order, 'coef': best_coef}, p
 
-    def forecast(self, ts: list(), lib_conf, roll: int = 1000, n_steps: int = 1):
+    def forecast(self, ts: np.ndarray, lib_conf, roll: int = 1000, n_steps: int = 1, m_sim: int = 1,
+                 rng: np.random.Generator = None):
         """
         This function calls the R rugarch library to produce a the ARMA-GARCH forecast.
         :param self - current selected model
-        :param ts - current series
+        :param ts - current series (array, sliced without copies)
         :param lib_conf: TSpackage for R library to use
         :param roll: max-size of rolling window fed to forecast
         :param n_steps: number of steps ahead forecasted
+        :param m_sim: number of independent simulations (paths) of the n_steps
+        :param rng: random generator of the simulations (unseeded if None). rugarch gets a seed drawn from it.
         out_sample: Optional.
             If a specification object is supplied, indicates how many data points to keep for out of sample testing.
         n.roll argument which controls how many times to roll the n.ahead forecast.
@@ -279,8 +339,11 @@ class Model:
             the ugarchfit function needs to be called with the argument out.sample being at least as large as
             the n.roll argument, or in the case of a specification being used instead of a fit object,
             the out.sample argument directly in the forecast function.
-        :return forecast or the next time horizon
+        :return forecast or the next time horizon (the forecasts of each step for all the simulations, if m_sim > 1)
         """
+        if lib_conf['lib'] == 'arch':
+            return ARCH_BACKEND.simulate(self.ARMAGARCHfitted, ts[-roll:] if len(ts) > roll else ts,
+                                         self.p, self.g_p, self.g_q, n_steps, m_sim, rng)
         if self.rugarch_lib_instance is None:
             self.rugarch_lib_instance = importr(lib_conf['lib'], lib_conf['env'])
         # forecast = self.rugarch_lib_instance.ugarchforecast(fit=self.ARMAGARCHspec,
@@ -296,12 +359,17 @@ class Model:
         # The main difference between uGARCHforecast and uGARCHsim is that the second one has a random seed.
         # Thus, each simulartion can change.
         # ugarchpath does the same than uGARCHsim but receiving a GARCH spec instead of a fitted objetd.
-        simulation = self.rugarch_lib_instance.ugarchsim(fit=self.ARMAGARCHfitted, n_sim=n_steps, m_sim=1,
-                                                         prereturns=ts[-roll:] if len(ts) > roll else ts)
+        # The seed of each simulation is drawn from rng, so a seeded run is reproducible with rugarch too.
+        sim_kwargs = dict() if rng is None else {'rseed': int(rng.integers(2 ** 31 - 1))}
+        numpy2ri.activate()  # Used to convert the series (list or array) to R
+        simulation = self.rugarch_lib_instance.ugarchsim(fit=self.ARMAGARCHfitted, n_sim=n_steps, m_sim=m_sim,
+                                                         prereturns=np.asarray(ts[-roll:] if len(ts) > roll else ts),
+                                                         **sim_kwargs)
+        numpy2ri.deactivate()
         # simulation = self.rugarch_lib_instance.ugarchpath(fit=self.ARMAGARCHspec, n_sim=n_steps, m_sim=1,
         #                                                 prereturns=ts[-roll:] if len(ts) > roll else ts)  # equivalent
 
-        return np.array(simulation.slots['simulation'].rx2('seriesSim')).flatten()  # n_steps
+        return np.array(simulation.slots['simulation'].rx2('seriesSim')).flatten()  # n_steps x m_sim
 
 
 
@@ -0,0 +1,33 @@
+import numpy as np
+from src import generator
+
+
+def test_aic_lower_bound_uses_best_supermodel():
+    # ARMA(3, 2) did not converge, so its log-likelihood is far below the one of ARMA(2, 2)
+    llf = {(2, 2): -100.0, (3, 2): -500.0}
+    assert generator.get_aic_lower_bound((1, 1), llf) == 2 * 3 + 2 * 100.0
+    assert generator.get_aic_lower_bound((3, 1), llf) == 2 * 5 + 2 * 500.0
+    assert generator.get_aic_lower_bound((4, 1), llf) == -np.inf
+
+
+class ConstantModel:
+    """ Fitted model stub: its forecasts are its id. """
+
+    def __init__(self, id):
+        self.id = id
+        self.input_ts_array = np.zeros(10)
+        self.max_lag = 1
+        self.multiplier = 1
+
+    def forecast(self, ts, lib_conf, roll=1000, n_steps=1, m_sim=1, rng=None):
+        return np.full(n_steps * m_sim, float(self.id))
+
+
+def test_switching_process_with_map_past_periods():
+    models = {f'{generator.MODEL_DICT_NAMES}{i}': ConstantModel(i) for i in (1, 2)}
+    tool_params = {'periods': 1200, 'w_func': 'sig', 'seed': 1, 'switching_probability': 0.0, 'min_model_len': 0,
+                   'use_transition_map': True, 'transition_map': [[500, 0, 2], [1700, 100, 1]],
+                   'gradual_drift_sharpness': 0.5, 'abrupt_drift_sharpness': 1, 'roll_window_size': 1000}
+    ts, rc = generator.switching_process(tool_params, models, {'files': [1, 2]}, {'lib': 'arch'}, False)
+    assert len(ts) == 1200
+    assert (ts[:500] == 1).all() and (ts[500:] == 2).all()